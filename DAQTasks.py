@@ -1,6 +1,7 @@
 from PyDAQmx import *  # pylint: disable=W0614
 import numpy as np
-from time import time, sleep
+import functools
+from time import monotonic
 import os
 
 """PyDAQmx provides an OOP wrapper to the DAQmx C Library. All commands
@@ -12,17 +13,38 @@ of each DAQmx command, see
 
 SAMPRATE = 1e6  # Define a sampling rate such that 1 sample = 1 microsecond
 
+# Generated flipping pulses are normally written on a coarser 10 microsecond grid, a
+# tenth of the data per reconfigure. This has NOT been validated against a scope trace
+# on the hardware. When the clip point const / amplitude falls within the first
+# MIN_CLIP_SAMPLES coarse samples the leading edge and early decay would be poorly
+# resolved, so such pulses keep the original 1 microsecond grid.
+PULSE_SAMPRATE = 1e5
+MIN_CLIP_SAMPLES = 100
+
+N_PULSE = int(9.25e3)  # Samples in the 1/t decay of the flipping pulse
+N_PAD = int(7.25e2)    # Samples of constant amplitude padding after the decay
+N_PULSE_FINE = int(92.5e3)  # As N_PULSE and N_PAD, at SAMPRATE
+N_PAD_FINE = int(7.25e3)
+N_READ = 50            # Samples read back by ReadbackTask per trigger
+PLOT_BLOCKS = 512      # Roughly how many min / max blocks the pulse plot is reduced to
+
+# Reciprocal time values from 0 to 100ms on each grid, computed once and shared by every
+# AnalogTask
+_INV_T = 1.0 / np.linspace(1 / PULSE_SAMPRATE, 92.5e-3, num=N_PULSE)
+_INV_T.setflags(write=False)
+_INV_T_FINE = 1.0 / np.linspace(1 / SAMPRATE, 92.5e-3, num=N_PULSE_FINE)
+_INV_T_FINE.setflags(write=False)
+
 
 def ZeroOutput():
     """Sets all the analog output channels of the DAQ card to 0V"""
 
-    for chan in ["dev1/ao0", "dev1/ao1"]:
-        sleep(1)
+    task = Task()
 
-        task = Task()
-
-        wrote = int32()
+    wrote = int32()
 
+    # Both channels share one task and sample clock, so they are zeroed together
+    for chan in ["dev1/ao0", "dev1/ao1"]:
         task.CreateAOVoltageChan(chan,
                                  "",
                                  0, 10,
@@ -30,75 +52,167 @@ def ZeroOutput():
                                  None
                                  )
 
-        task.CfgSampClkTiming("",
-                              5e4,
-                              DAQmx_Val_Rising,      # pylint: disable=E0602
-                              DAQmx_Val_FiniteSamps,  # pylint: disable=E0602
-                              2
-                              )
+    task.CfgSampClkTiming("",
+                          5e4,
+                          DAQmx_Val_Rising,      # pylint: disable=E0602
+                          DAQmx_Val_FiniteSamps,  # pylint: disable=E0602
+                          2
+                          )
+
+    # Two samples per channel, grouped by channel
+    task.WriteAnalogF64(2,
+                        False,
+                        1e-2,
+                        DAQmx_Val_GroupByChannel,  # pylint: disable=E0602
+                        np.zeros(4, dtype=np.float64),  # pylint: disable=E1101
+                        wrote,
+                        None
+                        )
+
+    task.StartTask()
+    task.ClearTask()
+
+
+def _pulse_grid(const, amplitude):
+    """Picks the sample grid for a generated pulse, see PULSE_SAMPRATE.
+
+    Returns the sample rate, the total number of samples and the reciprocal time table.
+    """
+
+    if const < amplitude * MIN_CLIP_SAMPLES / PULSE_SAMPRATE:
+        return SAMPRATE, N_PULSE_FINE + N_PAD_FINE, _INV_T_FINE
+
+    return PULSE_SAMPRATE, N_PULSE + N_PAD, _INV_T
 
-        task.WriteAnalogF64(2,
-                            False,
-                            1e-2,
-                            DAQmx_Val_GroupByChannel,  # pylint: disable=E0602
-                            np.array(
-                                [0.0], dtype=np.float64),  # pylint: disable=E1101
-                            wrote,
-                            None
-                            )
 
-        task.StartTask()
-        task.ClearTask()
+def _fill_pulse(pulse, const, amplitude, inv_t):
+    """Writes the clipped 1/t flipping pulse, padded with the amplitude, into pulse."""
+
+    n = len(inv_t)
+
+    # Build const / t in place and clip to the amplitude in a single pass
+    np.multiply(inv_t, const, out=pulse[:n])
+    np.minimum(pulse[:n], amplitude, out=pulse[:n])
+
+    # Pad the end of the waveform with the amplitude
+    pulse[n:] = amplitude
+
+
+def _block_size(n):
+    """Samples per min / max block when decimating n samples for plotting."""
+
+    return max(1, n // PLOT_BLOCKS)
+
+
+def _decimate_minmax(y):
+    """Reduces y to the min and max of roughly PLOT_BLOCKS blocks for plotting.
+
+    Keeping both extremes of each block draws the same trace as the full waveform at
+    widget resolution. The time of each point is given by _xaxis(len(y), samprate).
+    """
+
+    n = len(y)
+    k = _block_size(n)
+    blocks = y[:k * (n // k)].reshape(-1, k)
+
+    return np.stack([blocks.min(1), blocks.max(1)], 1).ravel()
+
+
+@functools.lru_cache(maxsize=8)
+def _xaxis(n, samprate):
+    """Time in ms of each point returned by _decimate_minmax for n samples at samprate.
+
+    The waveform length rarely changes, so the axis is cached rather than rebuilt every
+    toggle. It is returned read-only as the same array is shared between plots.
+    """
+
+    k = _block_size(n)
+    x = np.repeat(np.arange(n // k) * k, 2) * (1e3 / samprate)
+    x.setflags(write=False)
+    return x
+
+
+def _load_waveform(waveform_fn):
+    """Loads a waveform text file via a parsed binary copy cached alongside it.
+
+    The text is only parsed when "<waveform_fn>.npy" is missing or older than the text
+    file, otherwise the cached samples are memory mapped straight from disk.
+    """
+
+    cache_fn = waveform_fn + ".npy"
+
+    if (not os.path.isfile(cache_fn)
+            or os.path.getmtime(cache_fn) < os.path.getmtime(waveform_fn)):
+        wave = np.loadtxt(waveform_fn, dtype=np.float64)
+        try:
+            np.save(cache_fn, wave)
+        except OSError:
+            return wave  # Can't write next to the waveform, just use the parsed text
+
+    return np.load(cache_fn, mmap_mode='r').astype(np.float64, copy=False)
 
 
 class AnalogTask(Task):
-    """Task that drives the current to the flipping coil.
+    """Task that drives the current to the flipping and compensation coils.
 
     This task is triggered by the Analog Input start trigger, which is in turn triggered
     by a timing signal supplied to the terminal "APFI0". This trick is required as two
     tasks cannot both reserve APFI0, but conveniently also syncs the write and read tasks
     for us. Otherwise, this is a bogstandard retriggerable regenerated task that writes
-    the functional form we want.
+    the functional form we want to the flipping coil (ao1) alongside a constant level to
+    the compensation coil (ao0), both on the one sample clock.
     """
 
-    def __init__(self, const, amplitude, waveform_fn = None):
+    def __init__(self, const, amplitude, compensation, buf, waveform_fn = None):
         Task.__init__(self)
 
-        if waveform_fn and os.path.isfile(os.path.join(os.getcwd(), waveform_fn)):
-            self.write = np.loadtxt(waveform_fn, unpack=True)
+        # buf is a preallocated float64 array of 2 * (N_PULSE_FINE + N_PAD_FINE) samples
+        # owned by the caller, reused across constructions so no new waveform is
+        # allocated per toggle. It is laid out grouped by channel: ao0 samples first,
+        # then ao1.
+        self.from_file = bool(waveform_fn and os.path.isfile(waveform_fn))
+
+        if self.from_file:
+            wave = _load_waveform(waveform_fn)
+            n = len(wave)
+            if 2 * n > len(buf):
+                buf = np.empty(2 * n, dtype=np.float64)
+            buf[n:2 * n] = wave
+            samprate = SAMPRATE  # Waveform files are written 1 sample per microsecond
         else:
-            t = np.linspace(1e-6, 92.5e-3, num=92.5e3)  # Time values from 0 to 100ms
-            self.write = const / (t)
+            samprate, n, inv_t = _pulse_grid(const, amplitude)
+            _fill_pulse(buf[n:2 * n], const, amplitude, inv_t)
 
-            # Modulate the amplitude
-            self.write[np.where(self.write > amplitude)] = amplitude
+        buf[:n] = compensation
 
-            padding = np.ones((int(7.25e3),))*amplitude
-            self.write = np.concatenate((self.write, padding))
-
-        wrote = int32()
+        self.n = n
+        self._buf = buf
+        self.xaxis = _xaxis(n, samprate)  # Plot axis for thumb, fixed for the task's life
 
         """DAQmx procedure:
 
-        1) Create Analog Output channel.
-        2) Configure Sample Clock to time a sample every microsecond.
+        1) Create Analog Output channels for the compensation and flipping coils.
+        2) Configure Sample Clock to time a sample every microsecond for waveform files,
+           or every 10 microseconds for the generated pulse unless it is clipped too
+           early for that grid.
         3) Set the task to be regenerative (restores the buffered values after writing)
            and retriggerable (allows the write to trigger multiple times).
         4) Configure a digital edge start trigger to trigger off "ai/StartTrigger".
-        5) Write the desired signal to the buffer.
+        5) Write the desired signals to the buffer.
         """
 
-        self.CreateAOVoltageChan("dev1/ao1",
-                                 "",
-                                 0, 10,
-                                 DAQmx_Val_Volts,  # pylint: disable=E0602
-                                 None)
+        for chan in ["dev1/ao0", "dev1/ao1"]:
+            self.CreateAOVoltageChan(chan,
+                                     "",
+                                     0, 10,
+                                     DAQmx_Val_Volts,  # pylint: disable=E0602
+                                     None)
 
         self.CfgSampClkTiming("",
-                              SAMPRATE,
+                              samprate,
                               DAQmx_Val_Rising,      # pylint: disable=E0602
                               DAQmx_Val_FiniteSamps,  # pylint: disable=E0602
-                              len(self.write))
+                              n)
 
         self.SetWriteRegenMode(DAQmx_Val_AllowRegen)  # pylint: disable=E0602
 
@@ -108,54 +222,56 @@ class AnalogTask(Task):
                                  DAQmx_Val_RisingSlope    # pylint: disable=E0602
                                  )
 
-        self.WriteAnalogF64(len(self.write),
-                            False,
-                            0,
-                            DAQmx_Val_GroupByChannel,  # pylint: disable=E0602
-                            self.write,
-                            wrote,
-                            None
-                            )
+        self._write_buffer()
 
+    def rewrite(self, const, amplitude, compensation):
+        """Updates the output levels in place without tearing down the task.
 
-class CompensationTask(Task):
-    """Task that sets the compensation coil current to a constant value."""
+        The task is stopped, the buffer rewritten with the new settings and the task
+        restarted, leaving the channel, clock and trigger configuration untouched. A
+        waveform loaded from file is kept as is, only the compensation level changes.
 
-    def __init__(self, amplitude):
-        Task.__init__(self)
+        Returns False without touching the task if the new settings move the pulse to
+        the other sample grid (see PULSE_SAMPRATE), as the task's shape then changes and
+        it must be cleared and recreated instead.
+        """
 
-        # Arbitrarily n = 100 samples, can be any n > 2
-        write = amplitude * np.ones((100,))
-        wrote = int32()
+        if not self.from_file:
+            _, n, inv_t = _pulse_grid(const, amplitude)
+            if n != self.n:
+                return False
 
-        """DAQmx procedure:
+        self.StopTask()
 
-        1) Create Analog Output channel.
-        2) Configure Sample Clock timing.
-        3) Write value to the output buffer.
-        """
+        if not self.from_file:
+            _fill_pulse(self._buf[n:2 * n], const, amplitude, inv_t)
 
-        self.CreateAOVoltageChan("dev1/ao0",
-                                 "",
-                                 0, 10,
-                                 DAQmx_Val_Volts,  # pylint: disable=E0602
-                                 None)
+        self._buf[:self.n] = compensation
 
-        self.CfgSampClkTiming("",
-                              SAMPRATE,
-                              DAQmx_Val_Rising,      # pylint: disable=E0602
-                              DAQmx_Val_FiniteSamps,  # pylint: disable=E0602
-                              len(write))
+        self._write_buffer()
+
+        self.StartTask()
+
+        return True
+
+    def _write_buffer(self):
+        """Writes both channels of the buffer to the task and refreshes the thumbnail."""
 
-        self.WriteAnalogF64(len(write),
+        wrote = int32()
+
+        self.WriteAnalogF64(self.n,
                             False,
-                            1e-2,
+                            0,
                             DAQmx_Val_GroupByChannel,  # pylint: disable=E0602
-                            write,
+                            self._buf[:2 * self.n],
                             wrote,
                             None
                             )
 
+        # Plot a downsampled thumbnail of the flipping coil waveform rather than every
+        # sample written to DAQmx.
+        self.thumb = _decimate_minmax(self._buf[self.n:2 * self.n])
+
 
 class ReadbackTask(Task):
     """Task the reads back a signal supplied to the input terminal.
@@ -176,8 +292,10 @@ class ReadbackTask(Task):
         self.i = 0
         self.freq = 0
         self.missed = 0
-        self.data = np.zeros(int(50))
-        self.time = time()
+        self.data = np.zeros(N_READ, dtype=np.float64)
+        self._read = int32()  # Reused by every callback rather than allocated per read
+        self._read_f64 = self.ReadAnalogF64  # Bound once, the callback runs on a deadline
+        self.time = monotonic()
         self.sum_delta_t = 0
 
         """DAQmx procedure:
@@ -201,10 +319,10 @@ class ReadbackTask(Task):
                               SAMPRATE,
                               DAQmx_Val_Rising,       # pylint: disable=E0602
                               DAQmx_Val_FiniteSamps,  # pylint: disable=E0602
-                              int(50))
+                              N_READ)
 
         self.AutoRegisterEveryNSamplesEvent(DAQmx_Val_Acquired_Into_Buffer,  # pylint: disable=E0602
-                                            int(50),
+                                            N_READ,
                                             0)
 
         self.CfgAnlgEdgeStartTrig("APFI0",
@@ -216,13 +334,12 @@ class ReadbackTask(Task):
 
     def EveryNCallback(self):
         # Read the data out of the buffer
-        read = int32()
-        self.ReadAnalogF64(int(50),
-                           10,
-                           DAQmx_Val_GroupByScanNumber,  # pylint: disable=E0602
-                           self.data,
-                           int(50),
-                           read,
-                           None)
-
-        self.time = time()
+        self._read_f64(N_READ,
+                       10,
+                       DAQmx_Val_GroupByScanNumber,  # pylint: disable=E0602
+                       self.data,
+                       N_READ,
+                       self._read,
+                       None)
+
+        self.time = monotonic()
@@ -17,6 +17,7 @@ class QPlot(FigureCanvas):
         self.axes.set_ylabel(ylabel)
         self.xlabel = xlabel
         self.ylabel = ylabel
+        self.line = None
         FigureCanvas.__init__(self,fig)
         self.setParent(parent)
 
@@ -29,7 +30,20 @@ class QPlot(FigureCanvas):
         self.axes.cla()
         self.axes.set_xlabel(self.xlabel)
         self.axes.set_ylabel(self.ylabel)
-        self.axes.plot(x,y,format)
+        self.line, = self.axes.plot(x,y,format)
         self.draw()
+
+    def update_figure(self,x,y,format='r-'):
+        """Replaces the data of the plotted line in place, rather than redrawing the whole
+        figure from scratch as plot_figure does. Falls back to plot_figure the first time.
+        """
+        if self.line is None:
+            self.plot_figure(x,y,format)
+            return
+
+        self.line.set_data(x,y)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        self.draw_idle()
         
         
\ No newline at end of file
@@ -7,30 +7,56 @@ import numpy as np
 from QPlot import QPlot
 
 import sys
-import socket
-import threading
 import re
+import functools
+import logging
+import math
 
-from time import time, sleep
+from time import monotonic
 
-class SignalServer(QtCore.QObject):
-    """Simple implementation of a Qt threaded Python socket server.
+IDLE_TIMEOUT = 60000  # ms a command connection may stay open without sending anything
 
-    Recieves arbitrary TCP packets and scans for keywords. If a packet is recieved
-    containing a command corresponding to one of the Qt signals below, this signal is
-    emitted and, where necessary, passed a float argument parsed from the incoming
-    packet via regex.
+_CMD_RE = re.compile(rb"([a-z]+)\s*(.*)", re.S)  # Leading keyword and the rest
+_NUM_RE = re.compile(rb"[-+]?\d*\.\d+|\d+")  # Numeric argument of an incoming command
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_number(arg):
+    """Parses the numeric argument following a command keyword.
+
+    Well formed commands ("comp 1.5") parse directly, the regex is only used to dig the
+    number out of malformed packets. OpenGENIE scripts resend the same few setpoints, so
+    results are cached on the raw argument bytes.
+
+    Raises ValueError for nan / inf (or values overflowing to inf), as these would
+    otherwise reach spinboxes that drive the coil currents.
+    """
+    try:
+        value = float(arg)
+    except ValueError:
+        value = float(_NUM_RE.findall(arg)[0])
+
+    if not math.isfinite(value):
+        raise ValueError(f"Non-finite command argument {arg!r}")
+
+    return value
+
+
+class SignalServer(QtNetwork.QTcpServer):
+    """Simple implementation of a TCP server running on the Qt event loop.
+
+    Recieves arbitrary TCP packets and checks them for a leading keyword. If a packet is
+    recieved starting with a command corresponding to one of the Qt signals below, this
+    signal is emitted and, where necessary, passed a float argument parsed from the rest
+    of the incoming packet.
 
     To be used as follows:
 
-        >>thread = QThread()
         >>server = SignalServer('localhost', 80)
-        >>server.moveToThread(thread)
 
         >>server.toggle.connect(...)
 
-        >>thread.started.connect(server.listen)
-        >>thread.start()
+        >>server.listen()
 
     Attributes:
         toggle (pyqtSignal): Signal to toggle flipper on / off
@@ -46,83 +72,119 @@ class SignalServer(QtCore.QObject):
     fn = QtCore.pyqtSignal(str)
 
     def __init__(self, host, port, parent=None):
-        super(SignalServer, self).__init__()
-        self.host = host        # : Hostname on which to listen
+        super(SignalServer, self).__init__(parent)
+        self.host = host        # : Hostname on which to listen, all interfaces if empty
         self.port = port        # : Port on which to listen
         self.parent = parent    # Need a hook to the main class to retrieve settings
 
+        # Keyword -> (signal emitted with the parsed value, getter answering a "?" query)
+        self._setpoints = {
+            b"const": (self.const, lambda: self.parent.decay_spin.value()),
+            b"comp": (self.comp, lambda: self.parent.comp_spin.value()),
+            b"amp": (self.amp, lambda: self.parent.amplitude_spin.value()),
+        }
+
     def listen(self):
         """Listen for incoming connection requests.
 
-        This is an extremely standard implementation, see
-
-            https://docs.python.org/3/howto/sockets.html
+        Connections are accepted and read by Qt's own event loop on the main thread, so
+        no thread of our own is needed to avoid blocking the UI. The host may be an IP
+        address or a hostname, which is resolved here.
 
-        This function is threaded to prevent blocking of the main thread by the while
-        loop.
+        Returns True if the server is listening. On failure (e.g. the port is taken or
+        needs privileges) the error is logged and False returned, leaving the UI usable
+        without remote control.
         """
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((self.host, self.port))
-
-        sock.listen(5)
-        while True:
-            client, addr = sock.accept()
-            client.settimeout(60)
-            thread = threading.Thread(target=self.listenToClient, args=(client, addr))
-            thread.start()
-
-    def listenToClient(self, client, addr):
-        """Recieve message from accepted connection, parse, and close.
-
-        This function is called in a thread to prevent collisions between connections.
-        This threaded model is compatible with the Qt signals / slots model through the
-        use of QThread.
+        if not self.host:
+            address = QtNetwork.QHostAddress(QtNetwork.QHostAddress.Any)
+        else:
+            address = QtNetwork.QHostAddress(self.host)
+            if address.isNull():
+                # Not an IP literal, so look the hostname up
+                addresses = QtNetwork.QHostInfo.fromName(self.host).addresses()
+                if not addresses:
+                    logging.error("Command server could not resolve host %r", self.host)
+                    return False
+                address = addresses[0]
+
+        if not super(SignalServer, self).listen(address, self.port):
+            logging.error("Command server could not listen on %s:%d: %s",
+                          address.toString(), self.port, self.errorString())
+            return False
+
+        return True
+
+    def incomingConnection(self, socketDescriptor):
+        """Wrap an accepted connection in a socket and wait for its command."""
+
+        client = QtNetwork.QTcpSocket(self)
+        client.setSocketDescriptor(socketDescriptor)
+
+        # Commands and replies are tiny, don't let Nagle's algorithm hold them back
+        client.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+
+        client.readyRead.connect(self._handle)
+        client.disconnected.connect(client.deleteLater)
+
+        # Drop peers that connect but never send a command (e.g. port scanners), the
+        # timer is a child of the socket so it goes with it once the socket is deleted
+        idle = QtCore.QTimer(client)
+        idle.setSingleShot(True)
+        idle.timeout.connect(client.abort)
+        idle.start(IDLE_TIMEOUT)
+
+    def _handle(self):
+        """Recieve a single command from a readable connection, parse, and close.
+
+        Connected directly to each socket's readyRead, rather than through a closure per
+        connection, so the socket is recovered with sender().
         """
 
-        size = 1024
-        while True:
-            try:
-                data = client.recv(size)
-
-                if data and "comp" in str(data):
-                    if "?" in str(data):
-                        client.send(str(self.parent.comp_spin.value()).encode('utf-8'))
-                    else:
-                        self.comp.emit(float(re.findall(r"[-+]?\d*\.\d+|\d+", str(data))[0]))
-                if data and "amp" in str(data):
-                    if "?" in str(data):
-                        client.send(str(self.parent.amp_spin.value()).encode('utf-8'))
-                    else:
-                        self.amp.emit(float(re.findall(r"[-+]?\d*\.\d+|\d+", str(data))[0]))
-                if data and "const" in str(data):
-                    if "?" in str(data):
-                        client.send(str(self.parent.decay_spin.value()).encode('utf-8'))
-                    else:
-                        self.const.emit(float(re.findall(r"[-+]?\d*\.\d+|\d+", str(data))[0]))
-                if data and "file" in str(data):
-                    if "?" in str(data):
-                        client.send(str(self.parent.filename).encode('utf-8'))
-                    else:
-                        data = str(data,'utf-8').replace(" ","")
-                        self.fn.emit(data.replace("file",""))
-                if data and "toggle" in str(data):
-                    if "1" in str(data):
-                        self.toggle.emit(1)
-                    elif "0" in str(data):
-                        self.toggle.emit(0)
-                    else:
-                        self.toggle.emit(-1)
+        client = self.sender()
+
+        cmd = bytes(client.readAll()).strip()
+
+        try:
+            # Commands are "<keyword><value>", with any separator between the two, or
+            # "<keyword>?" to query the current value
+            query = cmd.endswith(b"?")
+            body = cmd.rstrip(b"?")
+
+            if body.startswith(b"file"):
+                # A filename may run straight on from the keyword ("filewave.txt"), so
+                # it can't be split off as the leading run of letters
+                keyword, arg = b"file", body[4:].strip()
+            else:
+                match = _CMD_RE.match(body)
+                if match is None:
+                    raise ValueError('No command keyword')
+                keyword, arg = match.groups()
+
+            if keyword == b"toggle":
+                if b"1" in arg:
+                    self.toggle.emit(1)
+                elif b"0" in arg:
+                    self.toggle.emit(0)
                 else:
-                    raise Exception('Client disconnected')
-
-                client.shutdown(socket.SHUT_RDWR)
-                client.close()
-            except BaseException:
-                client.shutdown(socket.SHUT_RDWR)
-                client.close()
-                return False
+                    self.toggle.emit(-1)
+            elif keyword == b"file":
+                if query:
+                    client.write(f"{self.parent.filename}\n".encode('utf-8'))
+                else:
+                    self.fn.emit(arg.decode('utf-8').replace(" ", ""))
+            else:
+                signal, current = self._setpoints[keyword]
+                if query:
+                    client.write(f"{current()}\n".encode('utf-8'))
+                else:
+                    signal.emit(_parse_number(arg))
+        except (KeyError, ValueError, IndexError) as e:
+            # Unrecognised or malformed command, note it and just close the connection
+            logging.warning("Ignoring command %r from %s: %r",
+                            cmd, client.peerAddress().toString(), e)
+        finally:
+            client.disconnectFromHost()  # Flushes any reply before closing
 
 
 class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
@@ -130,13 +192,10 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
 
     The class functionality can be broadly split into three components: UI, TCPIP server,
     and DAQmx tasks. The UI is bog standard Qt interface stuff, the TCPIP server is
-    itself documented above and then run inside a QThread, see
-
-        https://mayaposch.wordpress.com/2011/11/01/how-to-really-truly-use-qthreads-the-full-explanation/,
-
-    and the DAQmx tasks are started / stopped by calling onoff() alongside a simple state
-    flag that tracks if the flipper is currently on or off. See DAQTasks.py for detail
-    on the functionality of each task.
+    itself documented above and shares the UI's Qt event loop, and the DAQmx tasks are
+    started / stopped by calling onoff() alongside a simple state flag that tracks if the
+    flipper is currently on or off. See DAQTasks.py for detail on the functionality of
+    each task.
 
     When this window is closed, both analog output channels of the DAQ card will be
     zeroed.
@@ -148,7 +207,7 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
 
         # Quick botch to implement matplotlib widget, saves me bothering to make an actual
         # Qt widget for this.
-        self.pulseOutput = QPlot(self, xlabel="Sample", ylabel="Amplitude")
+        self.pulseOutput = QPlot(self, xlabel="Time / ms", ylabel="Amplitude")
         self.pulseOutput.setGeometry(QtCore.QRect(410, 10, 211, 161))
         self.pulseOutput.setObjectName("pulseOutput")
 
@@ -160,8 +219,6 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
 
         # Set up TCPIP server to recieve OpenGENIE commands
         self.server = SignalServer('', 80, self)
-        self.serverThread = QtCore.QThread()
-        self.server.moveToThread(self.serverThread)
 
         self.server.toggle.connect(self.toggle)
         self.server.comp.connect(self.compensate)
@@ -169,13 +226,16 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
         self.server.const.connect(self.const)
         self.server.fn.connect(self.fn)
 
-        self.serverThread.started.connect(self.server.listen)
-        self.serverThread.start()
+        self.server.listen()
 
         # Waveform filename, no file if filename=""
 
         self.filename=""
 
+        # Waveform buffer (compensation then flipping coil samples) shared by every
+        # AnalogTask, so toggling doesn't reallocate it
+        self._write_buf = np.empty(2 * (N_PULSE_FINE + N_PAD_FINE), dtype=np.float64)
+
         # We use ReadbackTask() to monitor if the beam drops. As we write 'amplitude' at the end
         # of our waveforms, we would default to constant, high current when the timing signal cuts.
         #
@@ -190,20 +250,29 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
         self.timeoutClock = QtCore.QTimer(self)
         self.timeoutClock.setInterval(1000)
 
+        _mono = monotonic  # Bound locally so each tick skips the global lookup
+
         def timeout():
-            t = time()
+            since = abs(_mono() - self.rtask.time)  # Seconds since the last trigger
 
-            if (self.running == 1) and (np.abs(t - self.rtask.time) > 5):
+            if (self.running == 1) and (since > 5):
                 self.off()
                 self.interrupted = 1
             
-            if (self.running == 0) and (self.interrupted == 1) and (np.abs(t - self.rtask.time) < 5):
+            if (self.running == 0) and (self.interrupted == 1) and (since < 5):
                 self.on()
                 self.interrupted = 0
         
         self.timeoutClock.timeout.connect(timeout)
         self.timeoutClock.start()
 
+        # Setpoints sent back-to-back by OpenGENIE (comp, amp, const) are coalesced so the
+        # running task is only rewritten once, 50ms after the last change in a burst.
+        self._applyTimer = QtCore.QTimer(self)
+        self._applyTimer.setSingleShot(True)
+        self._applyTimer.setInterval(50)
+        self._applyTimer.timeout.connect(self._applyPending)
+
     ##########################
     # OpenGENIE signal slots #
     ##########################
@@ -224,66 +293,50 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
 
     def const(self, amp):
         """Adjusts the decay constant for the flipper current"""
-        turnbackon = 0
-
-        if self.running == 1:
-            self.onoff()
-            turnbackon = 1
+        if self._unchanged(self.decay_spin, amp):
+            return
 
         self.decay_spin.setValue(amp)
 
-        if turnbackon == 1:
-            self.onoff()
+        if self.running == 1:
+            self._applyTimer.start()
 
     def amplitude(self, amp):
         """Adjusts the maximum allowed amplitude for the flipper current"""
-        turnbackon = 0
-
-        if self.running == 1:
-            self.onoff()
-            turnbackon = 1
+        if self._unchanged(self.amplitude_spin, amp):
+            return
 
         self.amplitude_spin.setValue(amp)
 
-        if turnbackon == 1:
-            self.onoff()
+        if self.running == 1:
+            self._applyTimer.start()
 
     def compensate(self, amp):
         """Adjusts the compensation current"""
-        turnbackon = 0
-
-        if self.running == 1:
-            self.onoff()
-            turnbackon = 1
+        if self._unchanged(self.comp_spin, amp):
+            return
 
         self.comp_spin.setValue(amp)
 
-        if turnbackon == 1:
-            self.onoff()
+        if self.running == 1:
+            self._applyTimer.start()
 
     ##########################
 
     def on(self):
         if self.running == 0:
-            ############################
-            # Set up compensation coil #
-            ############################
-
-            self.cmptask = CompensationTask(self.comp_spin.value())
-
-            self.cmptask.StartTask()
-            self.cmptask.ClearTask()
-
-            ##################################
-            # Start triggering flipping coil #
-            ##################################
+            ###################################################
+            # Start triggering flipping and compensation coil #
+            ###################################################
 
             self.atask = AnalogTask(self.decay_spin.value(),
                                     self.amplitude_spin.value(),
+                                    self.comp_spin.value(),
+                                    self._write_buf,
                                     self.filename)    # Analog signal output
+            self._applyTimer.stop()  # The new task already has the latest settings
 
-            self.pulseOutput.plot_figure(
-                np.arange(len(self.atask.write)), self.atask.write)
+            self.pulseOutput.update_figure(self.atask.xaxis, self.atask.thumb)
 
             self.atask.StartTask()
             
@@ -297,6 +350,27 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
         else:
             pass
 
+    def _unchanged(self, spin, value):
+        """True if setting value on spin would leave it as it is, after rounding"""
+        return round(value, spin.decimals()) == spin.value()
+
+    def _applyPending(self):
+        """Applies a burst of setpoint changes once it has settled"""
+        if self.running == 1:
+            self.rewrite()
+
+    def rewrite(self):
+        """Applies the current settings to the running task, recreating it only if the
+        new settings change the shape of the waveform"""
+        if not self.atask.rewrite(self.decay_spin.value(),
+                                  self.amplitude_spin.value(),
+                                  self.comp_spin.value()):
+            self.off()
+            self.on()
+            return
+
+        self.pulseOutput.update_figure(self.atask.xaxis, self.atask.thumb)
+
     def off(self):
         if self.running == 1:
             self.atask.ClearTask()
@@ -311,25 +385,18 @@ class Flippr(QtWidgets.QMainWindow, Ui_Flippr):
 
     def onoff(self):
         if self.running == 0:
-            ############################
-            # Set up compensation coil #
-            ############################
-
-            self.cmptask = CompensationTask(self.comp_spin.value())
-
-            self.cmptask.StartTask()
-            self.cmptask.ClearTask()
-
-            ##################################
-            # Start triggering flipping coil #
-            ##################################
+            ###################################################
+            # Start triggering flipping and compensation coil #
+            ###################################################
 
             self.atask = AnalogTask(self.decay_spin.value(),
                                     self.amplitude_spin.value(),
+                                    self.comp_spin.value(),
+                                    self._write_buf,
                                     self.filename)    # Analog signal output
+            self._applyTimer.stop()  # The new task already has the latest settings
 
-            self.pulseOutput.plot_figure(
-                np.arange(len(self.atask.write)), self.atask.write)
+            self.pulseOutput.update_figure(self.atask.xaxis, self.atask.thumb)
 
             self.atask.StartTask()
             